@@ -336,6 +336,9 @@
 
       // Watch for changes in WebUI resolution sliders
       const watchResolution = () => {
+        // Nothing to redraw while the tab is in the background
+        if (document.hidden) return;
+
         const currentWidth = this.getWebUIWidth() || 512;
         const currentHeight = this.getWebUIHeight() || 512;
 
@@ -368,6 +371,13 @@
           });
         }
       });
+
+      // Catch up on changes made while the tab was hidden
+      this.resourceManager.addEventListener(
+        document,
+        "visibilitychange",
+        watchResolution
+      );
     }
 
     setupBackendIntegration() {
@@ -5,6 +5,7 @@ https://github.com/laksjdjf/cgem156-ComfyUI/blob/main/scripts/attention_couple/n
 Modified by. Haoming02 to work with Forge
 """
 
+import math
 from functools import wraps
 from typing import Callable
 
@@ -13,13 +14,13 @@ from modules.devices import device, dtype_inference
 
 from lib_couple.logging import logger
 
-from .attention_masks import get_mask, lcm_for_list
+from .attention_masks import get_mask, lcm, lcm_for_list
 
 
 class AttentionCouple:
     def __init__(self):
         self.batch_size: int
-        self.patches: dict[str, Callable] = {}
+        self.patches: list[torch.nn.Module] = []
         self.manual: dict[str, list]
         self.checked: bool
 
@@ -37,19 +38,34 @@ class AttentionCouple:
         num_conds = len(kwargs) // 2 + 1
 
         mask = [base_mask] + [kwargs[f"mask_{i}"] for i in range(1, num_conds)]
-        mask = torch.stack(mask, dim=0).to(device, dtype=dtype_inference)
+        mask = torch.stack(mask, dim=0)
 
-        if mask.sum(dim=0).min().item() <= 0.0:
+        # check on the CPU copy, so it does not stall the device
+        mask_sum = mask.sum(dim=0, keepdim=True)
+        if mask_sum.min().item() <= 0.0:
             logger.error("Image must contain weights on all pixels...")
             return None
 
-        mask = mask / mask.sum(dim=0, keepdim=True)
+        mask.div_(mask_sum)
+        # every pixel belongs to exactly one region
+        disjoint: bool = ((mask == 0.0) | (mask == 1.0)).all().item()
+        mask = mask.to(device, dtype=dtype_inference, non_blocking=True)
 
+        # token counts may differ, so the conds cannot be stacked into one copy;
+        # issue all the copies without waiting on each of them instead
         conds = [
-            kwargs[f"cond_{i}"][0][0].to(device, dtype=dtype_inference)
+            kwargs[f"cond_{i}"][0][0].to(
+                device, dtype=dtype_inference, non_blocking=True
+            )
             for i in range(1, num_conds)
         ]
         num_tokens = [cond.shape[1] for cond in conds]
+        conds_lcm = lcm_for_list(num_tokens)
+
+        # local to this patch, so they are freed along with the patched UNet
+        plans: dict[tuple, tuple] = {}
+        masks: dict[tuple, torch.Tensor] = {}
+        buffers: dict[tuple, torch.Tensor] = {}
 
         if isA1111:
             self.manual = {
@@ -58,9 +74,79 @@ class AttentionCouple:
             }
             self.checked = False
 
+        def get_buffer(shape: tuple, like: torch.Tensor) -> torch.Tensor:
+            """
+            The attention calls never overlap, so every qs can be a view into
+            the same storage, which only grows to the largest size requested
+            """
+            numel = math.prod(shape)
+            key = (like.dtype, like.device)
+
+            buffer = buffers.get(key, None)
+            if buffer is None or buffer.numel() < numel:
+                buffer = buffers[key] = like.new_empty(numel)
+
+            return buffer[:numel].view(shape)
+
+        def build_plan(
+            q: torch.Tensor, k: torch.Tensor, cond_or_unconds: list[int]
+        ) -> tuple:
+            """
+            Everything but q / k / v stays the same throughout the sampling,
+            so resolve the row layout of qs / ks once into gather indices,
+            and write the conds rows of ks once and for all
+            """
+            batch_size = k.shape[0] // len(cond_or_unconds)
+            lcm_tokens = lcm(conds_lcm, k.shape[1])
+            conds_size = len(conds) * batch_size
+
+            q_idx, k_pos, conds_pos = [], [], []
+            pos = 0
+            for i, cond_or_uncond in enumerate(cond_or_unconds):
+                rows = list(range(i * batch_size, (i + 1) * batch_size))
+                k_pos.append((i * batch_size, pos))
+                pos += batch_size
+                if cond_or_uncond == 1:  # uncond
+                    q_idx += rows
+                else:
+                    q_idx += rows * num_conds
+                    conds_pos.append(pos)
+                    pos += conds_size
+
+            # pad to an even batch with an empty row
+            size = pos + pos % 2
+            tile = lcm_tokens // k.shape[1]
+
+            # all uncond with nothing to pad: q can be passed through as is,
+            # and so can k unless it needs to be tiled
+            passthrough = q_idx == list(range(size))
+            if passthrough and tile == 1:
+                return (tile, None, None, None, None)
+
+            ks = torch.empty(
+                (size, lcm_tokens, k.shape[2]), device=k.device, dtype=k.dtype
+            )
+            # all the other rows are overwritten anyway
+            ks[pos:].zero_()
+            for start in conds_pos:
+                for i, cond in enumerate(conds):
+                    # broadcast each cond into its rows instead of repeat()
+                    dst = ks[start + i * batch_size : start + (i + 1) * batch_size]
+                    dst.view(batch_size, -1, *cond.shape[1:]).copy_(cond.unsqueeze(1))
+
+            if passthrough:
+                return (tile, None, tuple(k_pos), None, ks)
+
+            return (
+                tile,
+                torch.tensor(q_idx, device=k.device),
+                tuple(k_pos),
+                (size, *q.shape[1:]),
+                ks,
+            )
+
         @torch.inference_mode()
         def attn2_patch(q, k, v, extra_options=None):
-            assert torch.allclose(k, v), "k and v should be the same"
             if extra_options is None:
                 if not self.checked:
                     self.manual["original_shape"][0] = k.size(0)
@@ -70,37 +156,30 @@ class AttentionCouple:
                 extra_options = self.manual
 
             cond_or_unconds = extra_options["cond_or_uncond"]
-            num_chunks = len(cond_or_unconds)
-            self.batch_size = q.shape[0] // num_chunks
-            q_chunks = q.chunk(num_chunks, dim=0)
-            k_chunks = k.chunk(num_chunks, dim=0)
-            lcm_tokens = lcm_for_list(num_tokens + [k.shape[1]])
-            conds_tensor = torch.cat(
-                [
-                    cond.repeat(self.batch_size, lcm_tokens // num_tokens[i], 1)
-                    for i, cond in enumerate(conds)
-                ],
-                dim=0,
-            )
+            self.batch_size = q.shape[0] // len(cond_or_unconds)
 
-            qs, ks = [], []
-            for i, cond_or_uncond in enumerate(cond_or_unconds):
-                k_target = k_chunks[i].repeat(1, lcm_tokens // k.shape[1], 1)
-                if cond_or_uncond == 1:  # uncond
-                    qs.append(q_chunks[i])
-                    ks.append(k_target)
-                else:
-                    qs.append(q_chunks[i].repeat(num_conds, 1, 1))
-                    ks.append(torch.cat([k_target, conds_tensor], dim=0))
+            key = (q.shape, k.shape, k.dtype, tuple(cond_or_unconds))
+            if (plan := plans.get(key, None)) is None:
+                plan = plans[key] = build_plan(q, k, cond_or_unconds)
+
+            tile, q_idx, k_pos, qs_shape, ks = plan
+            batch_size = self.batch_size
+
+            if q_idx is None:
+                qs = q
+            else:
+                qs = get_buffer(qs_shape, q)
+                torch.index_select(q, 0, q_idx, out=qs[: q_idx.shape[0]])
+                qs[q_idx.shape[0] :].zero_()
 
-            qs = torch.cat(qs, dim=0).to(q)
-            ks = torch.cat(ks, dim=0).to(k)
+            if ks is None:
+                return qs, k, k
 
-            if qs.size(0) % 2 == 1:
-                empty = torch.zeros_like(qs[0]).unsqueeze(0)
-                qs = torch.cat((qs, empty), dim=0)
-                empty = torch.zeros_like(ks[0]).unsqueeze(0)
-                ks = torch.cat((ks, empty), dim=0)
+            for src, dst in k_pos:
+                # broadcast the tiling straight into ks instead of repeat()
+                ks[dst : dst + batch_size].view(batch_size, tile, *k.shape[1:]).copy_(
+                    k[src : src + batch_size].unsqueeze(1)
+                )
 
             return qs, ks, ks
 
@@ -111,29 +190,60 @@ class AttentionCouple:
                 extra_options = self.manual
 
             cond_or_unconds = extra_options["cond_or_uncond"]
-            mask_downsample = get_mask(
-                mask, self.batch_size, out.shape[1], extra_options["original_shape"]
-            )
-            outputs = []
+            original_shape = extra_options["original_shape"]
+
+            # only a handful of resolutions within the UNet
+            key = (out.shape[1], out.dtype, self.batch_size, *original_shape[2:])
+            if (mask_downsample := masks.get(key, None)) is None:
+                mask_downsample = get_mask(
+                    mask, self.batch_size, out.shape[1], original_shape
+                ).view(num_conds, self.batch_size, out.shape[1], 1)
+                if disjoint:  # the index of the region of each pixel
+                    mask_downsample = mask_downsample.argmax(dim=0, keepdim=True)
+                else:
+                    mask_downsample = mask_downsample.to(out)
+                masks[key] = mask_downsample
+
+            batch_size = self.batch_size
+            output = out.new_empty((len(cond_or_unconds) * batch_size, *out.shape[1:]))
+
             pos = 0
-            for cond_or_uncond in cond_or_unconds:
+            for i, cond_or_uncond in enumerate(cond_or_unconds):
+                dst = output[i * batch_size : (i + 1) * batch_size]
                 if cond_or_uncond == 1:  # uncond
-                    outputs.append(out[pos : pos + self.batch_size])
-                    pos += self.batch_size
+                    dst.copy_(out[pos : pos + batch_size])
+                    pos += batch_size
                 else:
-                    masked_output = (
-                        out[pos : pos + num_conds * self.batch_size] * mask_downsample
-                    ).view(num_conds, self.batch_size, out.shape[1], out.shape[2])
-                    masked_output = masked_output.sum(dim=0)
-                    outputs.append(masked_output)
-                    pos += num_conds * self.batch_size
-            return torch.cat(outputs, dim=0)
+                    out_view = out[pos : pos + num_conds * batch_size].view(
+                        num_conds, batch_size, out.shape[1], out.shape[2]
+                    )
+                    if disjoint:  # pick the cond of each pixel
+                        torch.gather(
+                            out_view,
+                            0,
+                            mask_downsample.expand(1, *out_view.shape[1:]),
+                            out=dst.unsqueeze(0),
+                        )
+                    else:  # weighted sum over the conds, accumulated in place
+                        torch.mul(out_view[0], mask_downsample[0], out=dst)
+                        for n in range(1, num_conds):
+                            dst.addcmul_(out_view[n], mask_downsample[n])
+                    pos += num_conds * batch_size
+
+            return output
 
         if isA1111:
 
-            def patch_attn2(layer: str, module: torch.nn.Module):
-                f: Callable = module.forward
-                self.patches[layer] = f
+            def stash_forward(module: torch.nn.Module) -> Callable:
+                """Keep the original forward on the module itself"""
+                if not hasattr(module, "_fc_forward"):
+                    module._fc_forward = module.forward
+                    self.patches.append(module)
+
+                return module._fc_forward
+
+            def patch_attn2(module: torch.nn.Module):
+                f: Callable = stash_forward(module)
 
                 @wraps(f)
                 def _f(x, context, *args, **kwargs):
@@ -144,9 +254,8 @@ class AttentionCouple:
 
                 module.forward = _f
 
-            def patch_attn2_out(layer: str, module: torch.nn.Module):
-                f: Callable = module.forward
-                self.patches[layer] = f
+            def patch_attn2_out(module: torch.nn.Module):
+                f: Callable = stash_forward(module)
 
                 @wraps(f)
                 def _f(*args, **kwargs):
@@ -160,10 +269,10 @@ class AttentionCouple:
                     continue
 
                 if layer_name.endswith("2"):
-                    patch_attn2(layer_name, module)
+                    patch_attn2(module)
 
                 if layer_name.endswith("to_out"):
-                    patch_attn2_out(layer_name, module)
+                    patch_attn2_out(module)
 
             return True
 
@@ -175,12 +284,8 @@ class AttentionCouple:
 
     @torch.no_grad()
     def unpatch(self, model: torch.nn.Module):
-        if not self.patches:
-            return
-
-        for layer_name, module in model.named_modules():
-            if "attn2" not in layer_name:
-                continue
+        for module in self.patches:
+            module.forward = module._fc_forward
+            del module._fc_forward
 
-            if layer_name.endswith(("attn2", "to_out")):
-                module.forward = self.patches.pop(layer_name)
+        self.patches.clear()
@@ -9,10 +9,8 @@ from torch.nn.functional import interpolate
 
 
 def repeat_div(value: int, iterations: int) -> int:
-    for _ in range(iterations):
-        value = math.ceil(value / 2)
-
-    return value
+    """Halve and round up, iterations times; the same as a single ceil shift"""
+    return -(-value >> iterations)
 
 
 def get_mask(mask, batch_size, num_tokens, original_shape):
@@ -27,7 +25,10 @@ def get_mask(mask, batch_size, num_tokens, original_shape):
     image_width: int = original_shape[3]
     image_height: int = original_shape[2]
 
-    scale = math.ceil(math.log2(math.sqrt(image_height * image_width / num_tokens)))
+    # ceil(log2(sqrt(area / num_tokens))) in integers: the smallest scale
+    # where 4 ** scale covers ceil(area / num_tokens)
+    ratio = -(-(image_height * image_width) // num_tokens)
+    scale = ((ratio - 1).bit_length() + 1) // 2
     size = (repeat_div(image_height, scale), repeat_div(image_width, scale))
 
     num_conds = mask.shape[0]
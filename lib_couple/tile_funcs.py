@@ -13,31 +13,29 @@ from lib_couple.logging import logger
 SIZE = 1024  # image size used for overlap calculation
 
 
+def _grid(count: int) -> np.ndarray:
+    """Edges of the tiles along one axis, the last tile takes the remainder"""
+    edges = np.arange(count + 1) * (SIZE // count)
+    edges[-1] = SIZE
+    return edges
+
+
 def _include(
     x: int,
-    h: int,
     y: int,
-    v: int,
+    x_edges: np.ndarray,
+    y_edges: np.ndarray,
     mappings: list[np.ndarray],
+    totals: list[int],
     threshold: float,
 ) -> list[int]:
     include: list[int] = []
 
-    tile_width = SIZE // h
-    tile_height = SIZE // v
-
-    x1 = x * tile_width
-    y1 = y * tile_height
+    x1, x2 = x_edges[x], x_edges[x + 1]
+    y1, y2 = y_edges[y], y_edges[y + 1]
 
-    x2 = SIZE if x == h - 1 else (x + 1) * tile_width
-    y2 = SIZE if y == v - 1 else (y + 1) * tile_height
-
-    tile_mask = np.zeros((SIZE, SIZE), dtype=np.uint8)
-    tile_mask[y1:y2, x1:x2] = 1
-
-    for i, mask in enumerate(mappings):
-        overlap = np.sum((tile_mask == 1) & (mask == 1))
-        total = np.sum((mask == 1))
+    for i, (mask, total) in enumerate(zip(mappings, totals)):
+        overlap = np.sum(mask[y1:y2, x1:x2] == 1)
 
         if (overlap / total) >= threshold:
             include.append(i)
@@ -159,11 +157,16 @@ def calculate_tiles(self: "ForgeCouple", args: tuple) -> bool:
     tile_replace: str = args[15]
     replacements = _process_replacements(tile_replace)
 
+    x_edges = _grid(tile_h)
+    y_edges = _grid(tile_v)
+    # the area of each region does not depend on the tile
+    totals = [np.sum(mask == 1) for mask in mappings]
+
     for y in range(tile_v):
         for x in range(tile_h):
             _prompt = [bg] if bg else []
 
-            idx = _include(x, tile_h, y, tile_v, mappings, tile_threshold)
+            idx = _include(x, y, x_edges, y_edges, mappings, totals, tile_threshold)
             for i in idx:
                 p = prompts[i]
                 for k, v in replacements.items():
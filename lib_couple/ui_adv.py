@@ -134,10 +134,13 @@ def advanced_ui(
         elem_classes="fc_preview",
     )
 
+    # what the preview currently shows, to skip the identical redraws
+    preview_key = gr.State(None)
+
     preview_btn.click(
         visualize_mapping,
-        [mode, preview_res, mapping],
-        preview_img,
+        [mode, preview_res, mapping, preview_key],
+        [preview_img, preview_key],
         show_progress="hidden",
     ).success(None, **js(f'() => {{ ForgeCouple.updateColors("{m}"); }}'))
 
@@ -1,71 +1,201 @@
-from json import dumps, loads
+from collections import OrderedDict
 from json.decoder import JSONDecodeError
 
 import gradio as gr
-from PIL import Image, ImageDraw
+import numpy as np
+from PIL import Image, ImageColor
 
 from lib_couple.logging import logger
 
+try:
+    from orjson import dumps as _dumps
+    from orjson import loads
+except ImportError:
+    from json import dumps, loads
+else:
+
+    def dumps(obj) -> str:
+        return _dumps(obj).decode()
+
+
 DEFAULT_MAPPING = [[0.0, 0.5, 0.0, 1.0, 1.0], [0.5, 1.0, 0.0, 1.0, 1.0]]
 COLORS = ("red", "orange", "yellow", "green", "blue", "indigo", "violet")
+_COLORS_RGBA = np.array(
+    [(*ImageColor.getrgb(color), 255) for color in COLORS], dtype=np.uint8
+)
+
+_BACKGROUND_CACHE: OrderedDict[tuple[int, int], np.ndarray] = OrderedDict()
+_BACKGROUND_CACHE_SIZE = 3
+
+
+def _mapping_key(data: list) -> tuple | None:
+    """A hashable snapshot of the mapping; None if it is not a list of rows"""
+    try:
+        key = tuple(map(tuple, data))
+        hash(key)
+    except TypeError:
+        return None
+
+    return key
 
 
 def validate_mapping(data: list, log: bool = False) -> bool:
+    if log:  # go through each row to report what is wrong
+        return _validate_mapping_rows(data)
+
+    return _validate_array(_to_array(data))
+
+
+def _to_array(data: list) -> np.ndarray | None:
+    """The mapping as an (N, 5) float64 array; None if it is not numeric rows of 5"""
+    if len(data) == 0:
+        return np.empty((0, 5), dtype=np.float64)
+
+    try:
+        mapping = np.asarray(data)
+    except (ValueError, TypeError):  # ragged rows
+        return None
+
+    # bool / int / float only, the same as the row-by-row check
+    if mapping.ndim != 2 or mapping.shape[1] != 5 or mapping.dtype.kind not in "biuf":
+        return None
+
+    return mapping.astype(np.float64, copy=False)
+
+
+def _validate_array(mapping: np.ndarray | None) -> bool:
+    if mapping is None:
+        return False
+
+    x1, x2, y1, y2 = mapping[:, :4].T
+
+    return bool(
+        ((mapping[:, :4] >= 0.0) & (mapping[:, :4] <= 1.0)).all()
+        and (x2 >= x1).all()
+        and (y2 >= y1).all()
+    )
+
+
+def _validate_mapping_rows(data: list) -> bool:
     for x1, x2, y1, y2, w in data:
-        for v in (x1, x2, y1, y2, w):
-            if not (isinstance(v, float) or isinstance(v, int)):
-                if log:
-                    logger.error('Mappings must be "float"...')
-                return False
-
-        if not all(0.0 <= v <= 1.0 for v in (x1, x2, y1, y2)):
-            if log:
-                logger.error("Region range must be between 0.0 and 1.0...")
+        if not (
+            isinstance(x1, (int, float))
+            and isinstance(x2, (int, float))
+            and isinstance(y1, (int, float))
+            and isinstance(y2, (int, float))
+            and isinstance(w, (int, float))
+        ):
+            logger.error('Mappings must be "float"...')
+            return False
+
+        if not (
+            0.0 <= x1 <= 1.0
+            and 0.0 <= x2 <= 1.0
+            and 0.0 <= y1 <= 1.0
+            and 0.0 <= y2 <= 1.0
+        ):
+            logger.error("Region range must be between 0.0 and 1.0...")
             return False
 
         if x2 < x1 or y2 < y1:
-            if log:
-                logger.error('"to" value must be larger than "from" value...')
+            logger.error('"to" value must be larger than "from" value...')
             return False
 
     return True
 
 
-def visualize_mapping(mode: str, res: str, mapping: list) -> Image.Image:
-    if mode != "Advanced":
-        return gr.skip()
+def parse_resolution(res: str, max_area: int = 1024 * 1024) -> tuple[int, int]:
+    """Parse "WxH" and halve both sides until the area fits within max_area"""
+    w, h = res.split("x", 1)
+    w, h = int(w), int(h)
+
+    if (area := w * h) > max_area:
+        # the smallest shift that guarantees the fit, then check one less,
+        # as flooring each side may already get the area under the limit
+        s = ((-(-area // max_area) - 1).bit_length() + 1) // 2
+        if (w >> (s - 1)) * (h >> (s - 1)) <= max_area:
+            s -= 1
+        w, h = w >> s, h >> s
+
+    return (w, h)
+
+
+def upscale_resolution(w: int, h: int, min_area: int) -> tuple[int, int]:
+    """Double both sides until the area reaches min_area"""
+    if 0 < (area := w * h) < min_area:
+        s = ((-(-min_area // area) - 1).bit_length() + 1) // 2
+        w, h = w << s, h << s
 
-    p_width, p_height = [int(v) for v in res.split("x")]
+    return (w, h)
 
-    while p_width * p_height > 1024 * 1024:
-        p_width, p_height = p_width // 2, p_height // 2
 
-    while p_width * p_height < 512 * 512:
-        p_width, p_height = p_width * 2, p_height * 2
+def _draw_outline(
+    canvas: np.ndarray, x0: int, x1: int, y0: int, y1: int, width: int, color
+):
+    """Draw the (inclusive) rectangle outline with 4 slice assignments"""
+    x0, y0 = max(x0, 0), max(y0, 0)
+    x1, y1 = x1 + 1, y1 + 1
 
-    matt = Image.new("RGBA", (p_width, p_height), (0, 0, 0, 64))
+    canvas[y0 : min(y0 + width, y1), x0:x1] = color
+    canvas[max(y1 - width, y0) : y1, x0:x1] = color
+    canvas[y0:y1, x0 : min(x0 + width, x1)] = color
+    canvas[y0:y1, max(x1 - width, x0) : x1] = color
 
-    if not (validate_mapping(mapping)):
+
+def _background(w: int, h: int) -> np.ndarray:
+    """
+    The blank preview of the recent resolutions; copy it before drawing,
+    as Image.fromarray shares the memory with the returned array
+    """
+    if (matt := _BACKGROUND_CACHE.get((w, h), None)) is not None:
+        _BACKGROUND_CACHE.move_to_end((w, h))
         return matt
 
+    matt = np.empty((h, w, 4), dtype=np.uint8)
+    matt[...] = (0, 0, 0, 64)
+    matt.flags.writeable = False
+
+    _BACKGROUND_CACHE[(w, h)] = matt
+    if len(_BACKGROUND_CACHE) > _BACKGROUND_CACHE_SIZE:
+        _BACKGROUND_CACHE.popitem(last=False)
+
+    return matt
+
+
+def visualize_mapping(
+    mode: str, res: str, mapping: list, last_key: tuple | None = None
+) -> tuple[Image.Image, tuple | None]:
+    """Return the preview, along with the key of what it shows"""
+    if mode != "Advanced":
+        return gr.skip(), gr.skip()
+
+    p_width, p_height = parse_resolution(res)
+    p_width, p_height = upscale_resolution(p_width, p_height, 512 * 512)
+
+    if (mapping_key := _mapping_key(mapping)) is None:
+        key = None
+    elif (key := (p_width, p_height, mapping_key)) == last_key:
+        return gr.skip(), gr.skip()  # the same preview is already shown
+
+    matt = _background(p_width, p_height).copy()
+
+    # convert once, for both the check and the drawing
+    mapping = _to_array(mapping)
+    if not _validate_array(mapping):
+        return Image.fromarray(matt), key
+
     line_width = int(max(min(p_width, p_height) / 128, 4.0))
 
-    draw = ImageDraw.Draw(matt)
+    scale = np.array((p_width, p_width, p_height, p_height), dtype=np.float64)
+    coords = mapping[:, :4] * scale
 
-    for tile_index, (x1, x2, y1, y2, w) in enumerate(mapping):
-        x_from = int(p_width * x1)
-        x_to = int(p_width * x2)
-        y_from = int(p_height * y1)
-        y_to = int(p_height * y2)
+    coords = coords.astype(np.int32).tolist()
+    colors = _COLORS_RGBA[np.arange(len(coords)) % len(_COLORS_RGBA)]
 
-        color_index = tile_index % 7
-        draw.rectangle(
-            ((x_from, y_from), (x_to, y_to)),
-            outline=COLORS[color_index],
-            width=line_width,
-        )
+    for (x_from, x_to, y_from, y_to), color in zip(coords, colors):
+        _draw_outline(matt, x_from, x_to, y_from, y_to, line_width, color)
 
-    return matt
+    return Image.fromarray(matt), key
 
 
 def on_entry(data: str) -> list[list]:
@@ -83,8 +213,4 @@ def on_pull(data: dict) -> str:
     if not data:
         return ""
 
-    try:
-        return dumps(data)
-    except JSONDecodeError:
-        logger.error("Something went wrong while parsing advanced mapping...")
-        return ""
+    return dumps(data)
@@ -3,7 +3,7 @@ import numpy as np
 from PIL import Image
 
 from .gr_version import is_gradio_4, js
-from .ui_funcs import COLORS
+from .ui_funcs import COLORS, parse_resolution
 
 try:
     from modules_forge.forge_canvas.canvas import ForgeCanvas
@@ -26,7 +26,7 @@ class CoupleMaskData:
             self.weights = []
             return []
 
-        self.weights = [1.0 for _ in masks_data]
+        self.weights = [1.0] * len(masks_data)
         return [data["mask"] for data in masks_data]
 
     def get_masks(self) -> list[dict]:
@@ -38,7 +38,8 @@ class CoupleMaskData:
             return None
 
         return [
-            {"mask": self.masks[i], "weight": self.weights[i]} for i in range(count)
+            {"mask": mask, "weight": weight}
+            for mask, weight in zip(self.masks, self.weights)
         ]
 
     def mask_ui(self, btn, res, mode) -> list[gr.components.Component]:
@@ -275,12 +276,7 @@ class CoupleMaskData:
     @staticmethod
     def _parse_resolution(resolution: str) -> tuple[int, int]:
         """Convert the resolution from width and height slider"""
-        w, h = [int(v) for v in resolution.split("x")]
-        while w * h > 1024 * 1024:
-            w //= 2
-            h //= 2
-
-        return (w, h)
+        return parse_resolution(resolution)
 
     @staticmethod
     def _create_empty(resolution: str) -> list[Image.Image, None]:
@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 from json import dumps
 from typing import Callable
 
@@ -27,6 +28,15 @@ else:
 
 VERSION = "4.0.2"
 
+# (definition, reference) patterns of the common prompts, for each bracket style
+COMMON_PATTERNS: dict[tuple[str, str], tuple[re.Pattern, re.Pattern]] = {
+    (op, cs): (
+        re.compile(rf"{op}([^{op}{cs}]+?):([^{op}{cs}]+?){cs}"),
+        re.compile(rf"{op}([^{op}{cs}]+?){cs}"),
+    )
+    for op, cs in (("{", "}"), ("<", ">"))
+}
+
 
 class ForgeCouple(scripts.Script):
     forgeAttentionCouple = AttentionCouple()
@@ -97,26 +107,22 @@ class ForgeCouple(scripts.Script):
         return self.is_img2img and len(self.tiles) > 0
 
     @staticmethod
+    @lru_cache(maxsize=8)
     def parse_common_prompt(prompt: str, brackets: tuple[str]) -> str:
         common_prompts: dict[str, str] = {}
-        op, cs = brackets
+        definition, reference = COMMON_PATTERNS[brackets]
 
-        pattern = rf"{op}([^{op}{cs}]+?):([^{op}{cs}]+?){cs}"
-        matches = list(re.finditer(pattern, prompt))
-        for m in matches:
-            key: str = m.group(1).strip()
+        def _define(m: re.Match) -> str:
             val: str = m.group(2).strip()
-            prompt = prompt.replace(m.group(0), val)
-            common_prompts.update({key: val})
+            common_prompts.update({m.group(1).strip(): val})
+            return val
 
-        pattern = rf"{op}([^{op}{cs}]+?){cs}"
-        matches = list(re.finditer(pattern, prompt))
-        for m in matches:
-            key: str = m.group(1).strip()
-            if key in common_prompts:
-                prompt = prompt.replace(m.group(0), common_prompts[key])
+        def _expand(m: re.Match) -> str:
+            return common_prompts.get(m.group(1).strip(), m.group(0))
 
-        return prompt
+        # substitute every match in a single pass over the prompt
+        prompt = definition.sub(_define, prompt)
+        return reference.sub(_expand, prompt)
 
     def invalidate(self, p):
         self.valid = False
@@ -154,7 +160,7 @@ class ForgeCouple(scripts.Script):
         prompts: str = kwargs["prompts"][0]
 
         if common_parser in ("{ }", "< >"):
-            prompts = self.parse_common_prompt(prompts, common_parser.split(" "))
+            prompts = self.parse_common_prompt(prompts, tuple(common_parser.split(" ")))
             if common_debug:
                 print("")
                 logger.info(f"[Common Prompts Debug]\n{prompts}\n")